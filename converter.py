@@ -0,0 +1,499 @@
+"""
+File conversion pipeline: PDF/JSON quote parsing and Excel generation
+
+Kept free of Streamlit so worker processes can import it on its own
+"""
+import pymupdf
+import pdfplumber
+import re
+import orjson
+import io
+import xlsxwriter
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
+from collections import deque, namedtuple
+from itertools import groupby
+import os
+
+# Pages per pdfplumber open() when falling back on large PDFs
+PDF_PAGE_CHUNK_SIZE = 50
+
+# Leading bytes inspected when a file's type can't be told from its extension
+CONTENT_SNIFF_BYTES = 64
+
+# Quote tables are ruled, so pdfplumber only needs to look at drawn lines
+PDFPLUMBER_TABLE_SETTINGS = {
+    "vertical_strategy": "lines",
+    "horizontal_strategy": "lines",
+    "snap_tolerance": 3,
+}
+
+# Characters dropped from amount cells before parsing (thousands separators, currency sign, whitespace)
+_AMOUNT_STRIP = str.maketrans('', '', ', \t\r\n$')
+
+# Patterns used once per line/cell, compiled once at import
+_PAREN_TAIL_RE = re.compile(r'\s*\([^)]*\)\s*$')
+_LINE_BREAK_LABELS_RE = re.compile(r'(Entitlement Number:|Billing period:)')
+
+# Excel cell formats; xlsxwriter formats belong to a workbook, so only the properties are shared
+_CURRENCY_NUMBER_FORMAT = '#,##0.00'
+_HEADER_FORMAT = {'bold': True}
+_WRAP_FORMAT = {'text_wrap': True, 'valign': 'top'}
+_CURRENCY_FORMAT = {'num_format': _CURRENCY_NUMBER_FORMAT}
+_RED_CURRENCY_FORMAT = {'num_format': _CURRENCY_NUMBER_FORMAT, 'font_color': '#FF0000'}  # Red color for totals
+_RED_BOLD_CURRENCY_FORMAT = {'num_format': _CURRENCY_NUMBER_FORMAT, 'font_color': '#FF0000', 'bold': True}
+
+# One parsed table row; amount is in integer cents
+Row = namedtuple('Row', 'sno product amount discount')
+
+def detect_input_type_from_content(content: bytes, filename: str) -> str:
+    """
+    Detect if the input is PDF or JSON based on content and filename
+    """
+    file_extension = os.path.splitext(filename)[1].lower()
+    if file_extension == '.pdf':
+        return 'pdf'
+    elif file_extension == '.json':
+        return 'json'
+    else:
+        # Try to determine by content, sniffing only the first few raw bytes
+        head = content[:CONTENT_SNIFF_BYTES].lstrip()
+        if head.startswith(b'%PDF'):
+            return 'pdf'
+        if head[:1] in (b'{', b'['):
+            return 'json'
+        return 'pdf'  # Default to PDF
+
+def _find_lines(data: Any) -> Tuple[List[Any], List[str]]:
+    """
+    Find the billing lines list in parsed JSON and the key path leading to it
+    
+    Looks for a non-empty `upcomingBills.lines` under any key (or `lines` at the top
+    level), walking the tree once, shallowest match first
+    """
+    queue = deque([(data, [])])
+    while queue:
+        node, path = queue.popleft()
+        if isinstance(node, dict):
+            bills = node.get('upcomingBills')
+            if isinstance(bills, dict) and isinstance(bills.get('lines'), list) and bills['lines']:
+                return bills['lines'], path + ['upcomingBills', 'lines']
+            if node is data and isinstance(node.get('lines'), list) and node['lines']:
+                return node['lines'], ['lines']
+            queue.extend((value, path + [key]) for key, value in node.items())
+        elif isinstance(node, list):
+            queue.extend((item, path + [f"[{i}]"]) for i, item in enumerate(node))
+    return [], []
+
+def _emit_group(sno: str, group_data: Dict[str, Any]) -> Iterator[Row]:
+    """
+    Yield the table rows for one JSON product group: the head row, then its sub-items
+    """
+    amounts = group_data['amounts']
+    
+    # First item with full product description
+    yield Row(sno, group_data['product'], amounts[0] if amounts else 0, group_data['discount'])
+    
+    # Additional amounts for the same product (sub-items)
+    for amount in amounts[1:]:
+        yield Row('', '', amount, 'N')  # Empty S.no for sub-items
+
+def extract_from_json_content(json_content: bytes) -> Tuple[List[Row], List[Tuple[str, str]]]:
+    """
+    Extract billing data from JSON content - Updated to handle nested structure
+    
+    Returns the table data and a list of (level, message) log entries for the UI
+    """
+    logs = []
+    
+    try:
+        # orjson parses the UTF-8 bytes directly, no separate decode pass needed
+        data = orjson.loads(json_content)
+    except orjson.JSONDecodeError as e:
+        logs.append(("error", f"Error parsing JSON: {e}"))
+        return [], logs
+    
+    # Extract lines from wherever the billing lines are nested
+    lines, path = _find_lines(data)
+    if lines:
+        logs.append(("success", f"Found billing lines at: {' → '.join(path)}"))
+    
+    if not lines:
+        logs.append(("warning", "No billing lines found in JSON. Checking available structure..."))
+        # Debug: Show the top-level structure
+        if isinstance(data, dict):
+            logs.append(("info", f"Top-level keys found: {list(data.keys())}"))
+            
+            # Look for any nested upcomingBills
+            for key, value in data.items():
+                if isinstance(value, dict) and 'upcomingBills' in value:
+                    logs.append(("info", f"Found 'upcomingBills' under key: '{key}'"))
+                    if 'lines' in value['upcomingBills']:
+                        logs.append(("info", f"Found 'lines' under '{key}' → upcomingBills"))
+        return [], logs
+    
+    logs.append(("info", f"Processing {len(lines)} billing lines from JSON"))
+    
+    # Group lines by product description (base product name)
+    product_groups = {}
+    
+    # Bind hot lookups to locals once rather than per line
+    strip_price_details = _PAREN_TAIL_RE.sub
+    get_group = product_groups.get
+    
+    for line in lines:
+        get = line.get
+        description = get('description', '')
+        total = get('total', 0)
+        subTotal = get('subTotal', 0)  # Also check subTotal
+        margins = get('margins', ())
+        
+        # Use subTotal if total is 0; amounts stay in integer cents until written to Excel
+        amount = total or subTotal or 0
+        
+        # Skip zero amounts unless it's the only amount for a product
+        if amount == 0:
+            # Check if this is a zero line that should be included
+            is_credit_line = get('isCreditLine', False)
+            if not is_credit_line:
+                continue
+        
+        # Extract base product name (remove pricing details in parentheses)
+        base_product = strip_price_details('', description).strip()
+        if not base_product:
+            base_product = description
+        
+        # Check for discounts in margins; most lines have none, so skip any() entirely then
+        has_discount = 'Y' if margins and any(m.get('percent', 0) > 0 or m.get('amount') for m in margins) else 'N'
+        
+        # Group by base product name; a single get() covers both lookup and membership
+        group = get_group(base_product)
+        if group is None:
+            group = product_groups[base_product] = {
+                'product': description,  # Use full description for first item
+                'amounts': [],
+                'discount': has_discount
+            }
+        elif has_discount == 'Y':
+            # Update discount status if any item in group has discount
+            group['discount'] = 'Y'
+        
+        # Add amount to the group
+        group['amounts'].append(amount)
+    
+    if not product_groups:
+        logs.append(("warning", "No valid product groups found after processing billing lines"))
+        return [], logs
+    
+    # Convert to table data format
+    table_data = [
+        entry
+        for i, group_data in enumerate(product_groups.values(), 1)
+        for entry in _emit_group(str(i), group_data)
+    ]
+    
+    logs.append(("success", f"Successfully extracted {len(table_data)} items from {len(product_groups)} product groups"))
+    return table_data, logs
+
+def _parse_pdf_row(row: List[Any], sno_idx: int, product_idx: int, amount_excl_tax_idx: int,
+                   discount_idx: Optional[int], min_len: int) -> Optional[Row]:
+    """
+    Parse one PDF table data row, or return None if it is too short or empty
+    
+    `min_len` is the row length needed to reach every essential column, computed once per table
+    """
+    if len(row) < min_len:
+        return None
+    
+    # Each cell is converted and stripped exactly once
+    sno = str(row[sno_idx]).strip() if row[sno_idx] else ''
+    product = str(row[product_idx]).strip() if row[product_idx] else ''
+    amount_str = str(row[amount_excl_tax_idx]).strip() if row[amount_excl_tax_idx] else ''
+    discount_str = str(row[discount_idx]).strip() if discount_idx is not None and row[discount_idx] else ''
+    
+    # Skip empty rows
+    if not sno and not product and not amount_str:
+        return None
+    
+    # Parse amount (handle USD prefix, commas, negative values)
+    amount = parse_amount(amount_str)
+    
+    # Determine if there's a discount
+    has_discount = 'N' if discount_str in ('', '0') else 'Y'
+    
+    return Row(sno, product, amount, has_discount)
+
+def parse_pdf_table(table: List[List[Any]]) -> List[Row]:
+    """
+    Parse a single extracted PDF table (header row + data rows) into structured rows
+    """
+    if not table or len(table) < 2:
+        return []
+    
+    # Get headers from first row, lowercased once for matching
+    headers = [str(cell).strip().lower() if cell else '' for cell in table[0]]
+    
+    # Find relevant column indices
+    sno_idx = None
+    product_idx = None
+    amount_excl_tax_idx = None
+    discount_idx = None
+    
+    for i, header in enumerate(headers):
+        if 's.no' in header or 'sno' in header:
+            sno_idx = i
+        elif 'product' in header:
+            product_idx = i
+        elif 'amount' in header and 'excl' in header:
+            amount_excl_tax_idx = i
+        elif 'discount' in header:
+            discount_idx = i
+    
+    # Skip if we don't have essential columns
+    if sno_idx is None or product_idx is None or amount_excl_tax_idx is None:
+        return []
+    
+    min_len = max(sno_idx, product_idx, amount_excl_tax_idx) + 1
+    
+    # Process data rows, skipping the header row
+    return [
+        parsed
+        for row in table[1:]
+        if (parsed := _parse_pdf_row(row, sno_idx, product_idx, amount_excl_tax_idx, discount_idx, min_len)) is not None
+    ]
+
+def iter_pdf_rows(pdf_content: bytes, logs: List[Tuple[str, str]]) -> Iterator[Row]:
+    """
+    Yield structured table rows from PDF content one page at a time
+    
+    Uses PyMuPDF's table finder and falls back to pdfplumber when it finds nothing.
+    Only one page's tables are held in memory at once; (level, message) log
+    entries for the UI are appended to `logs`
+    """
+    found_rows = False
+    
+    try:
+        doc = pymupdf.open(stream=pdf_content, filetype="pdf")
+        try:
+            for page in doc:
+                # Extract tables from the page
+                for table in page.find_tables().tables:
+                    for row in parse_pdf_table(table.extract()):
+                        found_rows = True
+                        yield row
+        finally:
+            doc.close()
+    except Exception as e:
+        # Rows already handed to the caller can't be taken back, so only fall back cleanly
+        if found_rows:
+            raise
+        logs.append(("warning", f"PyMuPDF could not read the PDF, falling back to pdfplumber: {e}"))
+    
+    if found_rows:
+        return
+    
+    with pdfplumber.open(io.BytesIO(pdf_content)) as pdf:
+        page_count = len(pdf.pages)
+        if page_count <= PDF_PAGE_CHUNK_SIZE:
+            yield from _iter_pdfplumber_rows(pdf.pages)
+            return
+    
+    # Reopen large documents in chunks so pdfplumber never holds every parsed page at once
+    for chunk_start in range(1, page_count + 1, PDF_PAGE_CHUNK_SIZE):
+        pages = range(chunk_start, min(chunk_start + PDF_PAGE_CHUNK_SIZE, page_count + 1))
+        with pdfplumber.open(io.BytesIO(pdf_content), pages=pages) as pdf:
+            yield from _iter_pdfplumber_rows(pdf.pages)
+
+def _iter_pdfplumber_rows(pages: Iterable[Any]) -> Iterator[Row]:
+    """
+    Yield structured table rows from already-opened pdfplumber pages
+    """
+    for page in pages:
+        # Quote tables are ruled, so a page without any edges can't hold one
+        if page.edges:
+            # Extract tables from the page
+            tables = page.extract_tables(table_settings=PDFPLUMBER_TABLE_SETTINGS)
+            for table in tables:
+                yield from parse_pdf_table(table)
+            del tables
+        
+        # Release the page's cached layout objects before moving on
+        page.flush_cache()
+
+def parse_amount(amount_str: str) -> int:
+    """
+    Parse amount string to integer cents, handling USD prefix, commas, negatives
+    """
+    if not amount_str or amount_str == '':
+        return 0
+    
+    # Remove whitespace and commas in one pass, then the USD currency code wherever it
+    # sits, so "USD -5", "-USD 5", "- USD 5", "-5 USD" and "5usd" all parse
+    cleaned = amount_str.translate(_AMOUNT_STRIP).upper().replace('USD', '')
+    
+    # Handle negative values
+    is_negative = cleaned.startswith('-')
+    if is_negative:
+        cleaned = cleaned[1:]
+    
+    try:
+        value = round(float(cleaned) * 100)
+        return -value if is_negative else value
+    except (ValueError, OverflowError):
+        # float() accepts "inf"/"1e400", which can't be turned into cents
+        return 0
+
+def format_product_text(product_text: str) -> str:
+    """
+    Format product text with line breaks before Entitlement Number and Billing period
+    """
+    if not product_text:
+        return product_text
+    
+    # Add line breaks before "Entitlement Number:" and "Billing period:"
+    formatted_text = _LINE_BREAK_LABELS_RE.sub(r'\n\1', product_text)
+    
+    return formatted_text
+
+def group_by_sno(table_data: Iterable[Row]) -> Dict[str, List[Row]]:
+    """
+    Group items by S.no, handling cases where multiple items share the same S.no
+    """
+    current_sno = ''
+    
+    def owning_sno(item: Row) -> str:
+        nonlocal current_sno
+        # If S.no is empty, it belongs to the previous S.no
+        if item.sno:
+            current_sno = item.sno
+        return current_sno
+    
+    # Consecutive rows of the same S.no come out of groupby as one run
+    grouped = {}
+    for sno, items in groupby(table_data, key=owning_sno):
+        grouped.setdefault(sno, []).extend(items)
+    
+    return grouped
+
+def create_excel_content(grouped_data: Dict[str, List[Row]]) -> bytes:
+    """
+    Create Excel file content with enhanced formatting and formulas in column E
+    
+    Item amounts are integer cents and are converted to currency units as they are written
+    """
+    excel_buffer = io.BytesIO()
+    
+    # constant_memory flushes each row as soon as the next one starts, so the sheet
+    # is never held in memory (in_memory would turn this off again)
+    wb = xlsxwriter.Workbook(excel_buffer, {'constant_memory': True})
+    ws = wb.add_worksheet("Extracted Data")
+    
+    # Create formats once per workbook
+    header_format = wb.add_format(_HEADER_FORMAT)
+    wrap_format = wb.add_format(_WRAP_FORMAT)
+    currency = wb.add_format(_CURRENCY_FORMAT)
+    red_currency = wb.add_format(_RED_CURRENCY_FORMAT)
+    red_bold_currency = wb.add_format(_RED_BOLD_CURRENCY_FORMAT)
+    
+    # Set column widths (before any rows are written); cells written without a format
+    # pick up their column's format (wrapped products, currency amounts)
+    ws.set_column('A:A', 10)
+    ws.set_column('B:B', 12)
+    ws.set_column('C:C', 60, wrap_format)  # Much wider for product descriptions
+    ws.set_column('D:D', 18, currency)
+    ws.set_column('E:E', 18)
+    
+    # Set headers
+    ws.write_row(0, 0, ['S.no', 'Discount?', 'Product', 'Amount excl. tax', 'Total'], header_format)
+    
+    # Excel row number used in formulas; xlsxwriter itself takes zero-based rows
+    current_row = 2
+    
+    # Sort by S.no for consistent output: numeric S.no in numeric order, then any others
+    ordered_groups = sorted(
+        grouped_data.items(),
+        key=lambda group: (0, int(group[0])) if group[0].isdigit() else (1, group[0])
+    )
+    for sno, items in ordered_groups:
+        if not items:
+            continue
+        
+        # First item in the group
+        _, product, amount, discount = items[0]
+        
+        # Create formula for group total; rows are known up front from len(items)
+        group_start_row = current_row
+        group_end_row = current_row + len(items) - 1
+        
+        if len(items) == 1:
+            # Single item - formula just references the single cell
+            formula = f"=D{current_row}"
+        else:
+            # Multiple items - sum the range
+            formula = f"=SUM(D{group_start_row}:D{group_end_row})"
+        
+        row = current_row - 1
+        ws.write_string(row, 0, sno)
+        ws.write_string(row, 1, discount)
+        # Format product text with line breaks
+        ws.write_string(row, 2, format_product_text(product))
+        ws.write_number(row, 3, amount / 100)
+        ws.write_formula(row, 4, formula, red_currency)  # Make total red
+        
+        current_row += 1
+        
+        # Additional items under the same S.no (sub-items)
+        for item in items[1:]:
+            ws.write_number(current_row - 1, 3, item.amount / 100)
+            current_row += 1
+    
+    # Add grand total with formula
+    row = current_row - 1
+    ws.write_string(row, 3, "TOTAL", header_format)
+    
+    # Create grand total formula that sums all the group totals; column E holds nothing
+    # but group totals (sub-item rows leave it blank), so one contiguous range covers them
+    if current_row > 2:
+        ws.write_formula(row, 4, f"=SUM(E2:E{current_row - 1})", red_bold_currency)
+    else:
+        ws.write_number(row, 4, 0, red_bold_currency)
+    
+    # Save to bytes
+    wb.close()
+    # getvalue() hands back the buffer's own bytes object without copying
+    return excel_buffer.getvalue()
+
+def process_single_file(file_content: bytes, filename: str) -> Tuple[bytes, str, str, List[Tuple[str, str]]]:
+    """
+    Process a single file and return Excel content, status, message, and log entries
+    
+    Runs in a worker process, so it must not touch Streamlit; log entries are
+    returned as (level, message) pairs and rendered by the caller
+    """
+    logs = []
+    try:
+        # Detect input type
+        input_type = detect_input_type_from_content(file_content, filename)
+        
+        # Extract data based on input type
+        if input_type == 'json':
+            table_data, logs = extract_from_json_content(file_content)
+            if not table_data:
+                return None, "error", "No data extracted from JSON", logs
+            
+            # Group by S.no
+            grouped_data = group_by_sno(table_data)
+        else:  # PDF
+            # Rows are grouped as they stream off each page
+            grouped_data = group_by_sno(iter_pdf_rows(file_content, logs))
+            if not grouped_data:
+                return None, "error", "No tables found in PDF", logs
+        
+        item_count = sum(len(items) for items in grouped_data.values())
+        
+        # Create Excel content
+        excel_content = create_excel_content(grouped_data)
+        
+        return excel_content, "success", f"Successfully processed {item_count} items into {len(grouped_data)} groups", logs
+        
+    except Exception as e:
+        return None, "error", f"Error processing file: {str(e)}", logs